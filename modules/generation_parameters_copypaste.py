@@ -314,6 +314,7 @@ infotext_to_setting_name_mapping = [
     ('UniPC lower order final', 'uni_pc_lower_order_final'),
     ('RNG', 'randn_source'),
     ('NGMS', 's_min_uncond'),
+    ('Fast masking fill', 'fast_masking_fill'),
 ]
 
 
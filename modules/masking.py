@@ -1,3 +1,7 @@
+import functools
+
+import cv2
+import numpy as np
 from PIL import Image, ImageFilter, ImageOps
 
 
@@ -7,29 +11,14 @@ def get_crop_region(mask, pad=0):
     
     h, w = mask.shape
 
-    crop_left = 0
-    for i in range(w):
-        if not (mask[:, i] == 0).all():
-            break
-        crop_left += 1
-
-    crop_right = 0
-    for i in reversed(range(w)):
-        if not (mask[:, i] == 0).all():
-            break
-        crop_right += 1
-
-    crop_top = 0
-    for i in range(h):
-        if not (mask[i] == 0).all():
-            break
-        crop_top += 1
-
-    crop_bottom = 0
-    for i in reversed(range(h)):
-        if not (mask[i] == 0).all():
-            break
-        crop_bottom += 1
+    # indices of columns and rows that have at least one masked pixel
+    cols = np.flatnonzero(mask.any(axis=0))
+    rows = np.flatnonzero(mask.any(axis=1))
+
+    crop_left = cols[0] if len(cols) else w
+    crop_right = w - 1 - cols[-1] if len(cols) else w
+    crop_top = rows[0] if len(rows) else h
+    crop_bottom = h - 1 - rows[-1] if len(rows) else h
 
     return (
         int(max(crop_left-pad, 0)),
@@ -80,6 +69,32 @@ def expand_crop_region(crop_region, processing_width, processing_height, image_w
     return x1, y1, x2, y2
 
 
+@functools.lru_cache(maxsize=32)
+def gaussian_kernel(ksize, sigma):
+    """returns the 1D gaussian kernel for gaussian_blur; cached because the same mask blur is used for every image in a batch"""
+
+    return cv2.getGaussianKernel(ksize, sigma)
+
+
+# largest radius gaussian_blur does with an OpenCV kernel; the kernel's cost per pixel grows with the radius, while PIL's
+# box blur approximation costs the same for any radius, so it is faster for larger blurs
+gaussian_blur_max_kernel_radius = 8
+
+
+def gaussian_blur(image, radius):
+    """blurs an image with a gaussian of standard deviation radius, like ImageFilter.GaussianBlur does. Small radii are done
+    as two 1D passes using OpenCV, larger ones by PIL. Returns a new image of the same mode."""
+
+    if radius > gaussian_blur_max_kernel_radius:
+        return image.filter(ImageFilter.GaussianBlur(radius))
+
+    ksize = 2 * int(3 * radius) + 1
+    kernel = gaussian_kernel(ksize, radius)
+    blurred = cv2.sepFilter2D(np.asarray(image), -1, kernel, kernel, borderType=cv2.BORDER_REPLICATE)
+
+    return Image.fromarray(blurred, mode=image.mode)
+
+
 def fill(image, mask):
     """fills masked regions with colors from image using blur. Not extremely effective."""
 
@@ -97,3 +112,17 @@ def fill(image, mask):
 
     return image_mod.convert("RGB")
 
+
+def inpaint_fill(image, mask):
+    """fills masked regions with colors from image using OpenCV's Telea inpainting; a faster alternative to fill()"""
+
+    np_image = np.asarray(image.convert('RGB'))
+    np_mask = np.asarray(mask if mask.mode == 'L' else mask.convert('L'))
+
+    inpainted = cv2.inpaint(np_image, (np_mask > 0).astype(np.uint8), 3, cv2.INPAINT_TELEA)
+
+    # partially masked pixels get a mix of original and inpainted colors, like fill() produces for soft mask edges
+    alpha = np_mask[..., None].astype(np.float32) / 255.0
+    res = np_image * (1.0 - alpha) + inpainted * alpha
+
+    return Image.fromarray(res.round().astype(np.uint8))
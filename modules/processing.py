@@ -1,3 +1,5 @@
+import collections
+import functools
 import json
 import math
 import os
@@ -7,10 +9,10 @@ import hashlib
 
 import torch
 import numpy as np
-from PIL import Image, ImageFilter, ImageOps
+from PIL import Image, ImageOps
 import random
 import cv2
-from skimage import exposure
+from concurrent.futures import ThreadPoolExecutor
 from typing import Any, Dict, List, Optional
 
 import modules.sd_hijack
@@ -25,35 +27,112 @@ import modules.styles
 import modules.sd_models as sd_models
 import modules.sd_vae as sd_vae
 import logging
-from ldm.data.util import AddMiDaS
-from ldm.models.diffusion.ddpm import LatentDepth2ImageDiffusion
-
-from einops import repeat, rearrange
-from blendmodes.blend import blendLayers, BlendType
 
 # some of those options should not be changed at all because they would break the model, so I removed them from options.
 opt_C = 4
 opt_f = 8
 
+# how many distinct prompt batches process_images keeps conditionings for
+conds_cache_size = 8
+
+# pinned host memory reused for copying img2img init images to the device; only the last used shape is kept
+init_images_host_buffer = None
+
+# CUDA event recorded after the last copy from init_images_host_buffer; the buffer must not be written until it completes
+init_images_copy_event = None
+
+# LAB channels that color correction matches to the original; L is always kept from the image being corrected
+color_correction_channels = (1, 2)
+
 
 def setup_color_correction(image):
     logging.info("Calibrating color correction.")
-    correction_target = cv2.cvtColor(np.asarray(image.copy()), cv2.COLOR_RGB2LAB)
-    return correction_target
+    correction_target = cv2.cvtColor(np.asarray(image), cv2.COLOR_RGB2LAB)
+    return histogram_cdfs(correction_target, color_correction_channels)
+
+
+def histogram_cdfs(image, channels):
+    """returns normalized cumulative histograms of listed channels of uint8 image, as an array of shape (256, len(channels))"""
+
+    cdfs = np.empty((256, len(channels)), dtype=np.float32)
+
+    for i, c in enumerate(channels):
+        cdfs[:, i] = np.cumsum(cv2.calcHist([image], [c], None, [256], [0, 256]).ravel())
+
+    return cdfs / cdfs[-1]
+
+
+def match_histograms(source, reference_cdfs, channels):
+    """matches the histogram of listed channels of uint8 image source to cumulative histograms from histogram_cdfs(), leaving
+    other channels as they are; same as skimage's exposure.match_histograms, but done with a per-channel lookup table so that
+    the remapping is a single cv2.LUT call"""
+
+    source_cdfs = histogram_cdfs(source, channels)
+    lut = np.repeat(np.arange(256, dtype=np.uint8)[:, None, None], source.shape[2], axis=2)
+
+    for i, c in enumerate(channels):
+        lut[:, 0, c] = np.minimum(np.searchsorted(reference_cdfs[:, i], source_cdfs[:, i]), 255)
+
+    return cv2.LUT(source, lut)
 
 
 def apply_color_correction(correction, original_image):
     logging.info("Applying color correction.")
-    image = Image.fromarray(cv2.cvtColor(exposure.match_histograms(
-        cv2.cvtColor(
-            np.asarray(original_image),
-            cv2.COLOR_RGB2LAB
-        ),
-        correction,
-        channel_axis=2
-    ), cv2.COLOR_LAB2RGB).astype("uint8"))
+    original_lab = cv2.cvtColor(np.asarray(original_image), cv2.COLOR_RGB2LAB)
 
-    image = blendLayers(image, original_image, BlendType.LUMINOSITY)
+    # luminosity blend of the original over the matched image: only a and b are matched, L stays as in the original
+    matched_lab = match_histograms(original_lab, correction, color_correction_channels)
+
+    image = Image.fromarray(cv2.cvtColor(matched_lab, cv2.COLOR_LAB2RGB))
+
+    return image
+
+
+def apply_color_corrections(corrections, images_list):
+    """applies apply_color_correction to images that have a matching correction; returns a list of corrected images.
+    The work is done by OpenCV, which releases the GIL, so multiple images are processed in parallel threads."""
+
+    count = min(len(corrections), len(images_list))
+    if count <= 1:
+        return [apply_color_correction(corrections[i], images_list[i]) for i in range(count)]
+
+    with ThreadPoolExecutor(max_workers=min(count, os.cpu_count() or 1)) as executor:
+        return list(executor.map(apply_color_correction, corrections[:count], images_list[:count]))
+
+
+def create_overlay_image(image, mask):
+    """returns RGBA version of RGB image that is transparent where mask is white; same as pasting premultiplied image onto
+    a transparent canvas through the inverted mask, but built directly as one array"""
+
+    overlay = np.empty((image.height, image.width, 4), dtype=np.uint8)
+    overlay[..., :3] = np.asarray(image)
+    overlay[..., 3] = 255 - np.asarray(mask if mask.mode == 'L' else mask.convert('L'))
+    overlay[overlay[..., 3] == 0, :3] = 0
+
+    return Image.fromarray(overlay, 'RGBA')
+
+
+def init_images_to_device(batch_images):
+    """copies uint8 numpy batch of init images to the device; on CUDA, goes through a reused pinned host buffer, so that
+    the copy is a direct asynchronous DMA transfer rather than going through the driver's pageable memory staging"""
+
+    global init_images_host_buffer, init_images_copy_event
+
+    if shared.device.type != 'cuda':
+        return torch.from_numpy(batch_images).to(shared.device)
+
+    if init_images_copy_event is not None:
+        init_images_copy_event.synchronize()
+
+    if init_images_host_buffer is None or init_images_host_buffer.shape != batch_images.shape:
+        init_images_host_buffer = torch.empty(batch_images.shape, dtype=torch.uint8, pin_memory=True)
+
+    np.copyto(init_images_host_buffer.numpy(), batch_images)
+
+    image = init_images_host_buffer.to(shared.device, non_blocking=True)
+
+    init_images_copy_event = torch.cuda.Event()
+    init_images_copy_event.record(torch.cuda.current_stream(shared.device))
 
     return image
 
@@ -71,7 +150,10 @@ def apply_overlay(image, paste_loc, index, overlays):
         base_image.paste(image, (x, y))
         image = base_image
 
-    image = image.convert('RGBA')
+    # base_image from above is already a fresh RGBA image that can be composited onto directly
+    if paste_loc is None:
+        image = image.convert('RGBA')
+
     image.alpha_composite(overlay)
     image = image.convert('RGB')
 
@@ -99,7 +181,14 @@ def txt2img_image_conditioning(sd_model, x, width, height):
         # Dummy zero conditioning if we're not using inpainting or unclip models.
         # Still takes up a bit of memory, but no encoder call.
         # Pretty sure we can just make this a 1x1 image since its not going to be used besides its batch size.
-        return x.new_zeros(x.shape[0], 5, 1, 1, dtype=x.dtype, device=x.device)
+        return dummy_image_conditioning(x.shape[0], x.dtype, x.device)
+
+
+@functools.lru_cache(maxsize=16)
+def dummy_image_conditioning(batch_size, dtype, device):
+    """returns a zero conditioning tensor of shape (batch_size, 5, 1, 1); the tensor is shared between calls, so it must not be modified"""
+
+    return torch.zeros(batch_size, 5, 1, 1, dtype=dtype, device=device)
 
 
 class StableDiffusionProcessing:
@@ -177,6 +266,9 @@ class StableDiffusionProcessing:
         return txt2img_image_conditioning(self.sd_model, x, width or self.width, height or self.height)
 
     def depth2img_image_conditioning(self, source_image):
+        from ldm.data.util import AddMiDaS
+        from einops import repeat, rearrange
+
         # Use the AddMiDaS helper to Format our source image to suit the MiDaS model
         transformer = AddMiDaS(model_type="dpt_hybrid")
         transformed = transformer({"jpg": rearrange(source_image[0], "c h w -> h w c")})
@@ -201,6 +293,8 @@ class StableDiffusionProcessing:
         return conditioning_image
 
     def unclip_image_conditioning(self, source_image):
+        from einops import repeat
+
         c_adm = self.sd_model.embedder(source_image)
         if self.sd_model.noise_augmentor is not None:
             noise_level = 0 # TODO: Allow other noise levels?
@@ -216,12 +310,11 @@ class StableDiffusionProcessing:
             if torch.is_tensor(image_mask):
                 conditioning_mask = image_mask
             else:
-                conditioning_mask = np.array(image_mask.convert("L"))
-                conditioning_mask = conditioning_mask.astype(np.float32) / 255.0
-                conditioning_mask = torch.from_numpy(conditioning_mask[None, None])
+                conditioning_mask = torch.from_numpy(np.array(image_mask.convert("L"))).to(source_image.device)
 
-                # Inpainting model uses a discretized mask as input, so we round to either 1.0 or 0.0
-                conditioning_mask = torch.round(conditioning_mask)
+                # Inpainting model uses a discretized mask as input, so we round to either 1.0 or 0.0;
+                # for uint8 values rounding x / 255 is the same as comparing x to 128
+                conditioning_mask = (conditioning_mask[None, None] >= 128).float()
         else:
             conditioning_mask = source_image.new_ones(1, 1, *source_image.shape[-2:])
 
@@ -246,6 +339,8 @@ class StableDiffusionProcessing:
         return image_conditioning
 
     def img2img_image_conditioning(self, source_image, latent_image, image_mask=None):
+        from ldm.models.diffusion.ddpm import LatentDepth2ImageDiffusion
+
         source_image = devices.cond_cast_float(source_image)
 
         # HACK: Using introspection as the Depth2Image model doesn't appear to uniquely
@@ -311,10 +406,10 @@ class Processed:
         self.s_tmax = p.s_tmax
         self.s_noise = p.s_noise
         self.sampler_noise_scheduler_override = p.sampler_noise_scheduler_override
-        self.prompt = self.prompt if type(self.prompt) != list else self.prompt[0]
-        self.negative_prompt = self.negative_prompt if type(self.negative_prompt) != list else self.negative_prompt[0]
-        self.seed = int(self.seed if type(self.seed) != list else self.seed[0]) if self.seed is not None else -1
-        self.subseed = int(self.subseed if type(self.subseed) != list else self.subseed[0]) if self.subseed is not None else -1
+        self.prompt = self.prompt if not isinstance(self.prompt, list) else self.prompt[0]
+        self.negative_prompt = self.negative_prompt if not isinstance(self.negative_prompt, list) else self.negative_prompt[0]
+        self.seed = int(self.seed if not isinstance(self.seed, list) else self.seed[0]) if self.seed is not None else -1
+        self.subseed = int(self.subseed if not isinstance(self.subseed, list) else self.subseed[0]) if self.subseed is not None else -1
         self.is_using_inpainting_conditioning = p.is_using_inpainting_conditioning
 
         self.all_prompts = all_prompts or p.all_prompts or [self.prompt]
@@ -378,22 +473,26 @@ def slerp(val, low, high):
 
 def create_random_tensors(shape, seeds, subseeds=None, subseed_strength=0.0, seed_resize_from_h=0, seed_resize_from_w=0, p=None):
     eta_noise_seed_delta = opts.eta_noise_seed_delta or 0
-    xs = []
+    noise_shape = shape if seed_resize_from_h <= 0 or seed_resize_from_w <= 0 else (shape[0], seed_resize_from_h//8, seed_resize_from_w//8)
+
+    # noise is written into preallocated batch tensors on the device rather than collected and stacked at the end
+    xs = torch.empty((len(seeds), *shape), device=shared.device)
 
     # if we have multiple seeds, this means we are working with batch size>1; this then
     # enables the generation of additional tensors with noise that the sampler will use during its processing.
     # Using those pre-generated tensors instead of simple torch.randn allows a batch with seeds [100, 101] to
     # produce the same images as with two batches [100], [101].
     if p is not None and p.sampler is not None and (len(seeds) > 1 and opts.enable_batch_seeds or eta_noise_seed_delta > 0):
-        sampler_noises = [[] for _ in range(p.sampler.number_of_needed_noises(p))]
+        sampler_noises = [torch.empty((len(seeds), *noise_shape), device=shared.device) for _ in range(p.sampler.number_of_needed_noises(p))]
+        sampler_noise_shape = tuple(noise_shape)
     else:
         sampler_noises = None
 
     for i, seed in enumerate(seeds):
-        noise_shape = shape if seed_resize_from_h <= 0 or seed_resize_from_w <= 0 else (shape[0], seed_resize_from_h//8, seed_resize_from_w//8)
-
+        # with zero strength slerp returns the seed noise unchanged, and the reseed below makes the RNG state
+        # independent of whether the variation noise was drawn, so it is skipped entirely
         subnoise = None
-        if subseeds is not None:
+        if subseeds is not None and subseed_strength != 0:
             subseed = 0 if i >= len(subseeds) else subseeds[i]
 
             subnoise = devices.randn(subseed, noise_shape)
@@ -408,7 +507,6 @@ def create_random_tensors(shape, seeds, subseeds=None, subseed_strength=0.0, see
             noise = slerp(subseed_strength, noise, subnoise)
 
         if noise_shape != shape:
-            x = devices.randn(seed, shape)
             dx = (shape[2] - noise_shape[2]) // 2
             dy = (shape[1] - noise_shape[1]) // 2
             w = noise_shape[2] if dx >= 0 else noise_shape[2] + 2 * dx
@@ -418,25 +516,31 @@ def create_random_tensors(shape, seeds, subseeds=None, subseed_strength=0.0, see
             dx = max(-dx, 0)
             dy = max(-dy, 0)
 
+            # if the resized noise covers the whole tensor, none of the outer noise survives; it still has to be drawn
+            # unless the RNG is reseeded before anything reads it again: sampler noises and samplers that call
+            # torch.randn_like during sampling continue from this RNG state
+            reseeded_next = (sampler_noises is not None and eta_noise_seed_delta > 0) or (sampler_noises is None and i < len(seeds) - 1)
+            if w == shape[2] and h == shape[1] and reseeded_next:
+                x = noise.new_empty(shape)
+            else:
+                x = devices.randn(seed, shape)
+
             x[:, ty:ty+h, tx:tx+w] = noise[:, dy:dy+h, dx:dx+w]
             noise = x
 
         if sampler_noises is not None:
-            cnt = p.sampler.number_of_needed_noises(p)
-
             if eta_noise_seed_delta > 0:
                 torch.manual_seed(seed + eta_noise_seed_delta)
 
-            for j in range(cnt):
-                sampler_noises[j].append(devices.randn_without_seed(tuple(noise_shape)))
+            for sampler_noise in sampler_noises:
+                sampler_noise[i] = devices.randn_without_seed(sampler_noise_shape)
 
-        xs.append(noise)
+        xs[i] = noise
 
     if sampler_noises is not None:
-        p.sampler.sampler_noises = [torch.stack(n).to(shared.device) for n in sampler_noises]
+        p.sampler.sampler_noises = sampler_noises
 
-    x = torch.stack(xs).to(shared.device)
-    return x
+    return xs
 
 
 def decode_first_stage(model, x):
@@ -505,6 +609,17 @@ def create_infotext(p, all_prompts, all_seeds, all_subseeds, comments=None, iter
     return f"{all_prompts[index]}{negative_prompt_text}\n{generation_params_text}".strip()
 
 
+def apply_styles_to_prompts(apply_styles, prompts, styles):
+    """returns [apply_styles(x, styles) for x in prompts], applying styles only once to each distinct prompt"""
+
+    styled = {}
+    for prompt in prompts:
+        if prompt not in styled:
+            styled[prompt] = apply_styles(prompt, styles)
+
+    return [styled[prompt] for prompt in prompts]
+
+
 def process_images(p: StableDiffusionProcessing) -> Processed:
     stored_opts = {k: opts.data[k] for k in p.override_settings.keys()}
 
@@ -540,7 +655,7 @@ def process_images(p: StableDiffusionProcessing) -> Processed:
 def process_images_inner(p: StableDiffusionProcessing) -> Processed:
     """this is the main loop that both txt2img and img2img use; it calls func_init once inside all the scopes and func_sample once per batch"""
 
-    if type(p.prompt) == list:
+    if isinstance(p.prompt, list):
         assert(len(p.prompt) > 0)
     else:
         assert p.prompt is not None
@@ -555,25 +670,25 @@ def process_images_inner(p: StableDiffusionProcessing) -> Processed:
 
     comments = {}
 
-    if type(p.prompt) == list:
-        p.all_prompts = [shared.prompt_styles.apply_styles_to_prompt(x, p.styles) for x in p.prompt]
+    if isinstance(p.prompt, list):
+        p.all_prompts = apply_styles_to_prompts(shared.prompt_styles.apply_styles_to_prompt, p.prompt, p.styles)
     else:
         p.all_prompts = p.batch_size * p.n_iter * [shared.prompt_styles.apply_styles_to_prompt(p.prompt, p.styles)]
 
-    if type(p.negative_prompt) == list:
-        p.all_negative_prompts = [shared.prompt_styles.apply_negative_styles_to_prompt(x, p.styles) for x in p.negative_prompt]
+    if isinstance(p.negative_prompt, list):
+        p.all_negative_prompts = apply_styles_to_prompts(shared.prompt_styles.apply_negative_styles_to_prompt, p.negative_prompt, p.styles)
     else:
         p.all_negative_prompts = p.batch_size * p.n_iter * [shared.prompt_styles.apply_negative_styles_to_prompt(p.negative_prompt, p.styles)]
 
-    if type(seed) == list:
+    if isinstance(seed, list):
         p.all_seeds = seed
     else:
-        p.all_seeds = [int(seed) + (x if p.subseed_strength == 0 else 0) for x in range(len(p.all_prompts))]
+        p.all_seeds = list(range(int(seed), int(seed) + len(p.all_prompts))) if p.subseed_strength == 0 else [int(seed)] * len(p.all_prompts)
 
-    if type(subseed) == list:
+    if isinstance(subseed, list):
         p.all_subseeds = subseed
     else:
-        p.all_subseeds = [int(subseed) + x for x in range(len(p.all_prompts))]
+        p.all_subseeds = list(range(int(subseed), int(subseed) + len(p.all_prompts)))
 
     def infotext(iteration=0, position_in_batch=0):
         return create_infotext(p, p.all_prompts, p.all_seeds, p.all_subseeds, comments, iteration, position_in_batch)
@@ -587,28 +702,31 @@ def process_images_inner(p: StableDiffusionProcessing) -> Processed:
     infotexts = []
     output_images = []
 
-    cached_uc = [None, None]
-    cached_c = [None, None]
+    cached_uc = collections.OrderedDict()
+    cached_c = collections.OrderedDict()
 
     def get_conds_with_caching(function, required_prompts, steps, cache):
         """
         Returns the result of calling function(shared.sd_model, required_prompts, steps)
         using a cache to store the result if the same arguments have been used before.
 
-        cache is an array containing two elements. The first element is a tuple
-        representing the previously used arguments, or None if no arguments
-        have been used before. The second element is where the previously
-        computed result is stored.
+        cache is an OrderedDict mapping a tuple of previously used arguments to
+        the result computed for them. It keeps up to conds_cache_size entries,
+        dropping the least recently used one when full.
         """
 
-        if cache[0] is not None and (required_prompts, steps) == cache[0]:
-            return cache[1]
+        key = (tuple(required_prompts), steps)
+        if key in cache:
+            cache.move_to_end(key)
+            return cache[key]
 
         with devices.autocast():
-            cache[1] = function(shared.sd_model, required_prompts, steps)
+            cache[key] = function(shared.sd_model, required_prompts, steps)
+
+        if len(cache) > conds_cache_size:
+            cache.popitem(last=False)
 
-        cache[0] = (required_prompts, steps)
-        return cache[1]
+        return cache[key]
 
     with torch.no_grad(), p.sd_model.ema_scope():
         with devices.autocast():
@@ -679,12 +797,24 @@ def process_images_inner(p: StableDiffusionProcessing) -> Processed:
             with devices.without_autocast() if devices.unet_needs_upcast else devices.autocast():
                 samples_ddim = p.sample(conditioning=c, unconditional_conditioning=uc, seeds=seeds, subseeds=subseeds, subseed_strength=p.subseed_strength, prompts=prompts)
 
-            x_samples_ddim = [decode_first_stage(p.sd_model, samples_ddim[i:i+1].to(dtype=devices.dtype_vae))[0].cpu() for i in range(samples_ddim.size(0))]
-            for x in x_samples_ddim:
-                devices.test_for_nans(x, "vae")
+            # each decoded sample is copied into one CPU batch tensor right away, so that only one decoded image is on the device
+            # at a time; with pinned memory the copies are asynchronous and only need to be waited for once at the end
+            x_samples_ddim = None
+            for i in range(samples_ddim.size(0)):
+                x_sample = decode_first_stage(p.sd_model, samples_ddim[i:i+1].to(dtype=devices.dtype_vae))[0]
+                devices.test_for_nans(x_sample, "vae")
+
+                if x_samples_ddim is None:
+                    x_samples_ddim = torch.empty((samples_ddim.size(0), *x_sample.shape), dtype=x_sample.dtype, pin_memory=x_sample.device.type == 'cuda')
 
-            x_samples_ddim = torch.stack(x_samples_ddim).float()
-            x_samples_ddim = torch.clamp((x_samples_ddim + 1.0) / 2.0, min=0.0, max=1.0)
+                x_samples_ddim[i].copy_(x_sample, non_blocking=True)
+                del x_sample
+
+            if x_samples_ddim.is_pinned():
+                torch.cuda.current_stream(shared.device).synchronize()
+
+            x_samples_ddim = x_samples_ddim.float()
+            x_samples_ddim.add_(1.0).mul_(0.5).clamp_(min=0.0, max=1.0)
 
             del samples_ddim
 
@@ -696,11 +826,19 @@ def process_images_inner(p: StableDiffusionProcessing) -> Processed:
             if p.scripts is not None:
                 p.scripts.postprocess_batch(p, x_samples_ddim, batch_number=n)
 
-            for i, x_sample in enumerate(x_samples_ddim):
-                p.batch_index = i
+            # convert the whole batch to HWC uint8 at once rather than sample by sample
+            x_samples_uint8 = (255. * x_samples_ddim).permute(0, 2, 3, 1).to(torch.uint8).contiguous().numpy()
 
-                x_sample = 255. * np.moveaxis(x_sample.cpu().numpy(), 0, 2)
-                x_sample = x_sample.astype(np.uint8)
+            # color correction is done for the whole batch up front in parallel threads, but only when nothing that runs before it
+            # depends on the order of samples: face restoration can save images, and scripts can change parameters per image
+            postprocess_image_scripts = p.scripts is not None and any(type(script).postprocess_image is not scripts.Script.postprocess_image for script in p.scripts.alwayson_scripts)
+            if p.color_corrections is not None and not p.restore_faces and not postprocess_image_scripts:
+                color_corrected_images = apply_color_corrections(p.color_corrections, [Image.fromarray(x_sample) for x_sample in x_samples_uint8])
+            else:
+                color_corrected_images = None
+
+            for i, x_sample in enumerate(x_samples_uint8):
+                p.batch_index = i
 
                 if p.restore_faces:
                     if opts.save and not p.do_not_save_samples and opts.save_images_before_face_restoration:
@@ -722,14 +860,15 @@ def process_images_inner(p: StableDiffusionProcessing) -> Processed:
                     if opts.save and not p.do_not_save_samples and opts.save_images_before_color_correction:
                         image_without_cc = apply_overlay(image, p.paste_to, i, p.overlay_images)
                         images.save_image(image_without_cc, p.outpath_samples, "", seeds[i], prompts[i], opts.samples_format, info=infotext(n, i), p=p, suffix="-before-color-correction")
-                    image = apply_color_correction(p.color_corrections[i], image)
+                    image = color_corrected_images[i] if color_corrected_images is not None else apply_color_correction(p.color_corrections[i], image)
 
                 image = apply_overlay(image, p.paste_to, i, p.overlay_images)
 
+                text = infotext(n, i)
+
                 if opts.samples_save and not p.do_not_save_samples:
-                    images.save_image(image, p.outpath_samples, "", seeds[i], prompts[i], opts.samples_format, info=infotext(n, i), p=p)
+                    images.save_image(image, p.outpath_samples, "", seeds[i], prompts[i], opts.samples_format, info=text, p=p)
 
-                text = infotext(n, i)
                 infotexts.append(text)
                 if opts.enable_pnginfo:
                     image.info["parameters"] = text
@@ -737,13 +876,19 @@ def process_images_inner(p: StableDiffusionProcessing) -> Processed:
 
                 if hasattr(p, 'mask_for_overlay') and p.mask_for_overlay and any([opts.save_mask, opts.save_mask_composite, opts.return_mask, opts.return_mask_composite]):
                     image_mask = p.mask_for_overlay.convert('RGB')
-                    image_mask_composite = Image.composite(image.convert('RGBA').convert('RGBa'), Image.new('RGBa', image.size), images.resize_image(2, p.mask_for_overlay, image.width, image.height).convert('L')).convert('RGBA')
+
+                    # same as compositing the premultiplied image over a transparent one using the mask: alpha is scaled by the mask
+                    composite_mask = np.asarray(images.resize_image(2, p.mask_for_overlay, image.width, image.height).convert('L'))
+                    composite = np.array(image.convert('RGBA'))
+                    composite[..., 3] = composite[..., 3].astype(np.uint16) * composite_mask // 255
+                    composite[composite[..., 3] == 0, :3] = 0
+                    image_mask_composite = Image.fromarray(composite, 'RGBA')
 
                     if opts.save_mask:
-                        images.save_image(image_mask, p.outpath_samples, "", seeds[i], prompts[i], opts.samples_format, info=infotext(n, i), p=p, suffix="-mask")
+                        images.save_image(image_mask, p.outpath_samples, "", seeds[i], prompts[i], opts.samples_format, info=text, p=p, suffix="-mask")
 
                     if opts.save_mask_composite:
-                        images.save_image(image_mask_composite, p.outpath_samples, "", seeds[i], prompts[i], opts.samples_format, info=infotext(n, i), p=p, suffix="-mask-composite")
+                        images.save_image(image_mask_composite, p.outpath_samples, "", seeds[i], prompts[i], opts.samples_format, info=text, p=p, suffix="-mask-composite")
 
                     if opts.return_mask:
                         output_images.append(image_mask)
@@ -752,6 +897,7 @@ def process_images_inner(p: StableDiffusionProcessing) -> Processed:
                         output_images.append(image_mask_composite)
 
             del x_samples_ddim
+            del x_samples_uint8
 
             devices.torch_gc()
 
@@ -940,12 +1086,12 @@ class StableDiffusionProcessingTxt2Img(StableDiffusionProcessing):
                 image_conditioning = self.txt2img_image_conditioning(samples)
         else:
             decoded_samples = decode_first_stage(self.sd_model, samples)
-            lowres_samples = torch.clamp((decoded_samples + 1.0) / 2.0, min=0.0, max=1.0)
+            lowres_samples = decoded_samples.add_(1.0).mul_(0.5).clamp_(min=0.0, max=1.0)
+
+            lowres_samples = (255. * lowres_samples).permute(0, 2, 3, 1).to(torch.uint8).contiguous().cpu().numpy()
 
             batch_images = []
             for i, x_sample in enumerate(lowres_samples):
-                x_sample = 255. * np.moveaxis(x_sample.cpu().numpy(), 0, 2)
-                x_sample = x_sample.astype(np.uint8)
                 image = Image.fromarray(x_sample)
 
                 save_intermediate(image, i)
@@ -1022,12 +1168,12 @@ class StableDiffusionProcessingImg2Img(StableDiffusionProcessing):
                 image_mask = ImageOps.invert(image_mask)
 
             if self.mask_blur > 0:
-                image_mask = image_mask.filter(ImageFilter.GaussianBlur(self.mask_blur))
+                image_mask = masking.gaussian_blur(image_mask, self.mask_blur)
 
             if self.inpaint_full_res:
                 self.mask_for_overlay = image_mask
-                mask = image_mask.convert('L')
-                crop_region = masking.get_crop_region(np.array(mask), self.inpaint_full_res_padding)
+                mask = image_mask
+                crop_region = masking.get_crop_region(np.asarray(mask), self.inpaint_full_res_padding)
                 crop_region = masking.expand_crop_region(crop_region, self.width, self.height, mask.width, mask.height)
                 x1, y1, x2, y2 = crop_region
 
@@ -1036,8 +1182,7 @@ class StableDiffusionProcessingImg2Img(StableDiffusionProcessing):
                 self.paste_to = (x1, y1, x2-x1, y2-y1)
             else:
                 image_mask = images.resize_image(self.resize_mode, image_mask, self.width, self.height)
-                np_mask = np.array(image_mask)
-                np_mask = np.clip((np_mask.astype(np.float32)) * 2, 0, 255).astype(np.uint8)
+                np_mask = cv2.convertScaleAbs(np.asarray(image_mask), alpha=2.0)
                 self.mask_for_overlay = Image.fromarray(np_mask)
 
             self.overlay_images = []
@@ -1047,59 +1192,88 @@ class StableDiffusionProcessingImg2Img(StableDiffusionProcessing):
         add_color_corrections = opts.img2img_color_correction and self.color_corrections is None
         if add_color_corrections:
             self.color_corrections = []
-        imgs = []
-        for img in self.init_images:
 
-            # Save init image
-            if opts.save_init_img:
-                self.init_img_hash = hashlib.md5(img.tobytes()).hexdigest()
-                images.save_image(img, path=opts.outdir_init_images, basename=None, forced_filename=self.init_img_hash, save_to_dirs=False)
+        # OpenCV inpainting gives different pixels than the blur fill, so it is recorded to make the result reproducible
+        if image_mask is not None and self.inpainting_fill != 1 and opts.fast_masking_fill:
+            self.extra_generation_params["Fast masking fill"] = True
+
+        def resize_init_image(img):
+            """returns init image flattened and resized for processing, along with the uncropped image for the overlay.
+            This has to run on the calling thread, because resizing may run the img2img upscaler model."""
 
             image = images.flatten(img, opts.img2img_background_color)
 
             if crop_region is None and self.resize_mode != 3:
                 image = images.resize_image(self.resize_mode, image, self.width, self.height)
 
-            if image_mask is not None:
-                image_masked = Image.new('RGBa', (image.width, image.height))
-                image_masked.paste(image.convert("RGBA").convert("RGBa"), mask=ImageOps.invert(self.mask_for_overlay.convert('L')))
-
-                self.overlay_images.append(image_masked.convert('RGBA'))
+            uncropped_image = image
 
             # crop_region is not None if we are doing inpaint full res
             if crop_region is not None:
                 image = image.crop(crop_region)
                 image = images.resize_image(2, image, self.width, self.height)
 
+            return uncropped_image, image
+
+        def prepare_init_image(uncropped_image, image):
+            """returns resized init image filled for processing, along with its overlay image and color correction"""
+
+            overlay_image = create_overlay_image(uncropped_image, self.mask_for_overlay) if image_mask is not None else None
+
             if image_mask is not None:
                 if self.inpainting_fill != 1:
-                    image = masking.fill(image, latent_mask)
+                    image = masking.inpaint_fill(image, latent_mask) if opts.fast_masking_fill else masking.fill(image, latent_mask)
+
+            color_correction = setup_color_correction(image) if add_color_corrections else None
+
+            return image, overlay_image, color_correction
+
+        for img in self.init_images:
+
+            # Save init image
+            if opts.save_init_img:
+                self.init_img_hash = hashlib.md5(img.tobytes()).hexdigest()
+                images.save_image(img, path=opts.outdir_init_images, basename=None, forced_filename=self.init_img_hash, save_to_dirs=False)
+
+        resized_images = [resize_init_image(img) for img in self.init_images]
+
+        # the rest of the preparation is PIL and OpenCV work that releases the GIL, so multiple init images are prepared in parallel threads
+        if len(resized_images) > 1:
+            with ThreadPoolExecutor(max_workers=min(len(resized_images), os.cpu_count() or 1)) as executor:
+                prepared_images = list(executor.map(prepare_init_image, *zip(*resized_images)))
+        else:
+            prepared_images = [prepare_init_image(*resized) for resized in resized_images]
+
+        batch_images = None
+        for i, (image, overlay_image, color_correction) in enumerate(prepared_images):
+            if overlay_image is not None:
+                self.overlay_images.append(overlay_image)
 
             if add_color_corrections:
-                self.color_corrections.append(setup_color_correction(image))
+                self.color_corrections.append(color_correction)
 
-            image = np.array(image).astype(np.float32) / 255.0
-            image = np.moveaxis(image, 2, 0)
+            # images are written straight into the batch array instead of being collected and stacked afterwards
+            if batch_images is None:
+                batch_images = np.empty((len(prepared_images), image.height, image.width, 3), dtype=np.uint8)
 
-            imgs.append(image)
+            batch_images[i] = np.asarray(image)
 
-        if len(imgs) == 1:
-            batch_images = np.expand_dims(imgs[0], axis=0).repeat(self.batch_size, axis=0)
+        if len(batch_images) == 1:
+            batch_images = batch_images.repeat(self.batch_size, axis=0)
             if self.overlay_images is not None:
                 self.overlay_images = self.overlay_images * self.batch_size
 
             if self.color_corrections is not None and len(self.color_corrections) == 1:
                 self.color_corrections = self.color_corrections * self.batch_size
 
-        elif len(imgs) <= self.batch_size:
-            self.batch_size = len(imgs)
-            batch_images = np.array(imgs)
+        elif len(batch_images) <= self.batch_size:
+            self.batch_size = len(batch_images)
         else:
-            raise RuntimeError(f"bad number of images passed: {len(imgs)}; expecting {self.batch_size} or less")
+            raise RuntimeError(f"bad number of images passed: {len(batch_images)}; expecting {self.batch_size} or less")
 
-        image = torch.from_numpy(batch_images)
-        image = 2. * image - 1.
-        image = image.to(shared.device)
+        # images are sent to the device as uint8 HWC, and converted to float CHW in [-1, 1] there
+        image = init_images_to_device(batch_images)
+        image = image.permute(0, 3, 1, 2).contiguous().float().mul_(2.0 / 255.0).sub_(1.0)
 
         self.init_latent = self.sd_model.get_first_stage_encoding(self.sd_model.encode_first_stage(image))
 
@@ -1108,14 +1282,13 @@ class StableDiffusionProcessingImg2Img(StableDiffusionProcessing):
 
         if image_mask is not None:
             init_mask = latent_mask
-            latmask = init_mask.convert('RGB').resize((self.init_latent.shape[3], self.init_latent.shape[2]))
-            latmask = np.moveaxis(np.array(latmask, dtype=np.float32), 2, 0) / 255
-            latmask = latmask[0]
-            latmask = np.around(latmask)
-            latmask = np.tile(latmask[None], (4, 1, 1))
+            latmask = (init_mask if init_mask.mode == 'L' else init_mask.convert('L')).resize((self.init_latent.shape[3], self.init_latent.shape[2]))
+            latmask = torch.from_numpy(np.array(latmask)).to(shared.device)
+            latmask = (latmask >= 128)[None].float()
 
-            self.mask = torch.asarray(1.0 - latmask).to(shared.device).type(self.sd_model.dtype)
-            self.nmask = torch.asarray(latmask).to(shared.device).type(self.sd_model.dtype)
+            # all four latent channels share the same mask, so they are broadcast views rather than copies
+            self.mask = (1.0 - latmask).type(self.sd_model.dtype).expand(4, -1, -1)
+            self.nmask = latmask.type(self.sd_model.dtype).expand(4, -1, -1)
 
             # this needs to be fixed to be done in sample() using actual seeds for batches
             if self.inpainting_fill == 2:
@@ -1135,9 +1308,8 @@ class StableDiffusionProcessingImg2Img(StableDiffusionProcessing):
         samples = self.sampler.sample_img2img(self, self.init_latent, x, conditioning, unconditional_conditioning, image_conditioning=self.image_conditioning)
 
         if self.mask is not None:
-            samples = samples * self.nmask + self.init_latent * self.mask
+            samples.mul_(self.nmask).addcmul_(self.init_latent, self.mask)
 
         del x
-        devices.torch_gc()
 
         return samples